@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Бенчмарк конкуренції за склад: багато покупців одночасно намагаються купити
+# останні одиниці лімітованої позиції через ті самі reserve_into_basket /
+# commit_reservations, що й бот. Перевіряє, що продано рівно стільки, скільки
+# було, і що резерви не «протекли»; міряє пропускну здатність reserve/release
+# на одній гарячій позиції та на розкиданих.
+#
+#   python bench_stock.py --threads 16 --buyers 400 --units 5
+from __future__ import annotations
+
+import argparse, copy, os, sys, tempfile, threading, time
+from pathlib import Path
+
+os.environ["TELEGRAM_TOKEN"] = "123456:replay"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import bot_ptb13 as bot  # noqa: E402
+
+SCOPE = "desserts"
+
+def limited_menu(units: int) -> tuple:
+    raw = copy.deepcopy(bot.DEFAULT_MENU)
+    items = list(raw[SCOPE])
+    for iid in items:
+        raw[SCOPE][iid]["stock"] = units
+    cat = bot.Catalog(bot.validate_menu(raw))
+    bot.STOCK.configure(cat)
+    bot._MENU = cat
+    return items
+
+def run_threads(n: int, target) -> float:
+    start = threading.Barrier(n + 1)
+
+    def body(i):
+        start.wait()
+        target(i)
+
+    threads = [threading.Thread(target=body, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0
+
+def last_units(args, hot: str) -> list:
+    # Кожен покупець резервує 1 шт. і підтверджує; хто не встиг — отримує залишок
+    sold, lock = [0], threading.Lock()
+    per_thread = -(-args.buyers // args.threads)
+
+    def buyers(i):
+        for _ in range(per_thread):
+            ses = bot.Session()
+            if bot.reserve_into_basket(ses, SCOPE, hot, 1) is None and ses.reservations:
+                bot.commit_reservations(ses)
+                with lock:
+                    sold[0] += 1
+
+    elapsed = run_threads(args.threads, buyers)
+    on_hand, reserved = bot.STOCK.limited()[f"{SCOPE}:{hot}"]
+    saved = bot.STOCK._load()[f"{SCOPE}:{hot}"]["on_hand"]
+    print(f"last units: {per_thread * args.threads} buyers on {args.threads} threads for {args.units} units "
+          f"in {elapsed * 1000:.1f} ms -> sold {sold[0]}, on_hand {on_hand}, reserved {reserved}, saved {saved}")
+    problems = []
+    if sold[0] != args.units:
+        problems.append(f"sold {sold[0]} of {args.units}")
+    if (on_hand, reserved, saved) != (0, 0, 0):
+        problems.append(f"left on_hand={on_hand} reserved={reserved} saved={saved}")
+    return problems
+
+def churn(args, keys, label: str) -> list:
+    # reserve + release без запису на диск: чиста вартість локів лічильників
+    def worker(i):
+        key = keys[i % len(keys)]
+        for _ in range(args.ops):
+            if bot.STOCK.reserve(key, 1) is None:
+                bot.STOCK.release(key, 1)
+
+    elapsed = run_threads(args.threads, worker)
+    total = args.threads * args.ops
+    print(f"churn {label}: {total} reserve/release pairs in {elapsed:.2f}s ({total / elapsed:,.0f}/s)")
+    leaked = {k: r for k, (_, r) in bot.STOCK.limited().items() if r}
+    return [f"leaked reservations {leaked}"] if leaked else []
+
+def main():
+    ap = argparse.ArgumentParser(description="Stock reservation contention benchmark.")
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--buyers", type=int, default=400)
+    ap.add_argument("--units", type=int, default=5)
+    ap.add_argument("--ops", type=int, default=20000, help="reserve/release pairs per thread in churn runs")
+    args = ap.parse_args()
+
+    bot.STOCK._path = Path(tempfile.mkdtemp()) / "stock_state.json"  # не чіпаємо бойовий склад
+    items = limited_menu(args.units)
+    problems = last_units(args, items[0])
+
+    items = limited_menu(args.ops * args.threads)  # ресток: вистачить на будь-яку гонку
+    problems += churn(args, [f"{SCOPE}:{items[0]}"], "one hot item")
+    problems += churn(args, [f"{SCOPE}:{iid}" for iid in items], f"{len(items)} items")
+
+    for line in problems:
+        print(f"  {line}")
+    print("FAIL" if problems else "OK")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,16 +2,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-import os, json, logging, datetime as dt
+import os, sys, json, logging, math, random, re, threading, time, tracemalloc, atexit, datetime as dt
+import gzip, hashlib, hmac, html, queue, zlib
+from collections import deque
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, List, Optional, Set
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.error import BadRequest, NetworkError, TimedOut
 from telegram.ext import (
     Updater, CallbackContext, CommandHandler, CallbackQueryHandler,
-    MessageHandler, Filters
+    MessageHandler, Filters, ExtBot, TypeHandler
 )
+from telegram.utils.request import Request, Timeout
+
+try:
+    from telegram.vendor.ptb_urllib3.urllib3 import exceptions as urllib3_exc
+except ImportError:  # PTB без вендорного urllib3
+    from urllib3 import exceptions as urllib3_exc
 
 # ────────────────────────── CONFIG ──────────────────────────
 TOKEN = os.environ.get("TELEGRAM_TOKEN", "").strip()
@@ -19,16 +30,204 @@ if not TOKEN:
     raise SystemExit("Please set TELEGRAM_TOKEN env var.")
 ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID", "0") or "0")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s"
-)
+# Transport: пул = воркери диспетчера + 4 (updater, dispatcher, job queue, main),
+# окремі таймаути для long-poll та коротких викликів, ретраї з jitter-backoff.
+API_URL              = os.environ.get("TELEGRAM_API_URL", "").strip() or None  # напр. http://127.0.0.1:8081/bot
+WORKERS              = int(os.environ.get("BOT_WORKERS", "4"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT    = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+POLL_CONNECT_TIMEOUT = float(os.environ.get("POLL_CONNECT_TIMEOUT", "10"))
+POLL_TIMEOUT         = float(os.environ.get("POLL_TIMEOUT", "25"))
+HTTP_RETRIES         = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF         = float(os.environ.get("HTTP_BACKOFF", "0.5"))
+HTTP_BACKOFF_CAP     = float(os.environ.get("HTTP_BACKOFF_CAP", "8"))
+LOCK_STRIPES         = int(os.environ.get("LOCK_STRIPES", "64"))
+
+# Запис вхідних апдейтів для replay_updates.py (вимкнено, поки RECORD_DIR порожній)
+RECORD_DIR       = os.environ.get("RECORD_DIR", "").strip()
+RECORD_ROTATE_MB = float(os.environ.get("RECORD_ROTATE_MB", "50"))
+RECORD_KEEP      = int(os.environ.get("RECORD_KEEP", "20"))
+RECORD_ROTATE_MIN = float(os.environ.get("RECORD_ROTATE_MIN", "60"))   # ротація і за віком файлу
+RECORD_FLUSH_SECONDS = float(os.environ.get("RECORD_FLUSH_SECONDS", "1"))  # макс. інтервал sync flush під навантаженням
+REPLAY_ADMIN_ID  = 1  # під цим id адмін потрапляє в запис; replay запускає бота з ним
+
+# Прибирання неактивних сесій (JobQueue). CART_REMINDER_MIN=0 вимикає нагадування.
+SESSION_IDLE_HOURS = float(os.environ.get("SESSION_IDLE_HOURS", "24"))
+RESERVE_TTL_MIN    = float(os.environ.get("RESERVE_TTL_MIN", "15"))   # 0 — резерв живе до eviction
+CART_REMINDER_MIN  = float(os.environ.get("CART_REMINDER_MIN", "0"))
+AWAIT_TTL_MIN      = float(os.environ.get("AWAIT_TTL_MIN", "30"))
+SWEEP_SECONDS      = float(os.environ.get("SWEEP_SECONDS", "60"))
+REMINDERS_PER_SEC  = int(os.environ.get("REMINDERS_PER_SEC", "20"))
+
+# Logging: хендлери лише кладуть запис у обмежену чергу, JSON-форматування і
+# запис у stderr — у фоновому потоці. Переповнена черга відкидає записи.
+LOG_LEVEL        = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE   = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", "0.05"))
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("order_no", "chat_id", "route", "status", "latency_ms")
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for name in self.FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                out[name] = value
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, separators=(",", ":"))
+
+class DebugSampler(logging.Filter):
+    # Пропускає лише частку DEBUG-записів (per-toggle тощо), решту — без змін
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self._drop_lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # форматує вже listener
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._drop_lock:  # лише на шляху відкидання
+                self.dropped += 1
+
+def setup_logging() -> DroppingQueueHandler:
+    sink = logging.StreamHandler()
+    sink.setFormatter(JsonFormatter())
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # APScheduler пише INFO на кожен запуск job — для menu/sweep це шум
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+    listener = QueueListener(handler.queue, sink, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+LOG_HANDLER = setup_logging()
 log = logging.getLogger("shawarma-bot13")
 
 def now_str() -> str:
     return dt.datetime.now().strftime("%Y-%m-%d %H:%M")
 
+# ───────────────────────── HTTP TRANSPORT ───────────────────
+# Методи, які безпечно повторити, навіть якщо запит міг дійти до сервера
+# (read timeout, обрив зʼєднання, 5xx). Для send* повторюємо лише помилки
+# встановлення зʼєднання — інакше клієнт отримає дублікати.
+_IDEMPOTENT_PREFIXES = ("get", "edit", "answer", "delete")
+_HTTP_5XX = re.compile(r"(Bad Gateway|\(5\d\d\))$")
+# Відповідь на повтор edit*, перша спроба якого дійшла (впав лише read): Bot API
+# вважає це помилкою, а для нас це успіх — віддаємо те, що Bot повертає як True
+_EDIT_LANDED = b'{"ok":true,"result":true}'
+
+class PooledRequest(Request):
+    __slots__ = ("_poll_connect", "_short_read", "_retries", "_backoff", "_backoff_cap",
+                 "_stats_lock", "_stats")
+
+    def __init__(self, con_pool_size: int, connect_timeout: float, read_timeout: float,
+                 poll_connect_timeout: float, retries: int, backoff: float, backoff_cap: float):
+        super().__init__(con_pool_size=con_pool_size,
+                         connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self._poll_connect = poll_connect_timeout
+        self._short_read = read_timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._backoff_cap = backoff_cap
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "retries": 0, "failures": 0}
+
+    def post(self, url, data, timeout=None):
+        # getUpdates приходить з власним read timeout (poll + latency)
+        return super().post(url, data, self._short_read if timeout is None else timeout)
+
+    def _bump(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _transient(self, e: Exception, method: str) -> bool:
+        if isinstance(e, BadRequest):
+            return False
+        if isinstance(e.__cause__, urllib3_exc.ConnectTimeoutError):
+            return True  # запит не відправлено (включно з NewConnectionError)
+        if not method.startswith(_IDEMPOTENT_PREFIXES):
+            return False
+        return isinstance(e, TimedOut) or isinstance(e.__cause__, urllib3_exc.HTTPError) \
+            or bool(_HTTP_5XX.search(str(e)))
+
+    def _request_wrapper(self, *args, **kwargs):
+        method = str(args[1]).rsplit("/", 1)[-1]
+        t = kwargs.get("timeout")
+        if t is not None and method == "getUpdates":
+            kwargs["timeout"] = Timeout(connect=self._poll_connect, read=t.read_timeout)
+        kwargs["retries"] = False  # повтори робимо самі, з backoff
+        self._bump("calls")
+        attempt = 0
+        while True:
+            try:
+                return super()._request_wrapper(*args, **kwargs)
+            except NetworkError as e:
+                if (attempt and method.startswith("edit") and isinstance(e, BadRequest)
+                        and "message is not modified" in e.message.lower()):
+                    return _EDIT_LANDED
+                if attempt >= self._retries or not self._transient(e, method):
+                    self._bump("failures")
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(self._backoff_cap, self._backoff * 2 ** attempt))
+                log.warning("HTTP %s failed (%s), retry %d/%d in %.2fs", method, e, attempt, self._retries, delay)
+                self._bump("retries")
+                time.sleep(delay)
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            out = dict(self._stats)
+        sent = new_conns = 0
+        pools = getattr(self._con_pool, "pools", None)
+        if pools is not None:
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    sent += pool.num_requests; new_conns += pool.num_connections
+        out.update(pool_size=self.con_pool_size, http_requests=sent,
+                   new_connections=new_conns, reused=max(0, sent - new_conns))
+        return out
+
+def make_bot() -> ExtBot:
+    request = PooledRequest(
+        con_pool_size=WORKERS + 4,
+        connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+        poll_connect_timeout=POLL_CONNECT_TIMEOUT,
+        retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, backoff_cap=HTTP_BACKOFF_CAP,
+    )
+    return ExtBot(TOKEN, base_url=API_URL, request=request)
+
 # ───────────────────────── MENU / PRICES ─────────────────────
+# Вбудоване меню — використовується, доки немає MENU_FILE (JSON або TOML з тими ж
+# секціями: shawarma/addons/sides/desserts/drinks; у позиції можна додати
+# "available": false, щоб сховати її без рестарту, і "stock": N для лімітованих
+# позицій — зміна N у файлі означає нове поповнення).
+MENU_FILE = Path(os.environ.get("MENU_FILE", "").strip() or Path(__file__).parent / "menu.json")
+MENU_POLL_SECONDS = float(os.environ.get("MENU_POLL_SECONDS", "5"))
+
 SHAWARMA_ITEMS = {
     "koko":   {"name": "Коко",   "price": 260},
     "disney": {"name": "Дісней", "price": 160},
@@ -53,6 +252,146 @@ DRINKS = {
     "ayran":{"name": "Айран",     "price": 95},
     "capp": {"name": "Капучино",  "price": 120},
 }
+DEFAULT_MENU = {
+    "shawarma": SHAWARMA_ITEMS, "addons": ADDONS, "sides": SIDES,
+    "desserts": DESSERTS, "drinks": DRINKS,
+}
+MENU_SCOPES = tuple(DEFAULT_MENU)
+_ITEM_ID = re.compile(r"^[a-z0-9_]{1,32}$")  # має влізти в 64 байти callback_data
+
+class MenuError(ValueError):
+    pass
+
+def validate_menu(raw) -> Dict[str, Dict[str, dict]]:
+    if not isinstance(raw, dict):
+        raise MenuError("menu root must be an object")
+    unknown = set(raw) - set(MENU_SCOPES)
+    if unknown:
+        raise MenuError(f"unknown sections: {', '.join(sorted(unknown))}")
+    out = {}
+    for scope in MENU_SCOPES:
+        section = raw.get(scope, {})
+        if not isinstance(section, dict):
+            raise MenuError(f"{scope}: must be an object")
+        items = {}
+        for iid, meta in section.items():
+            where = f"{scope}.{iid}"
+            if not _ITEM_ID.match(iid):
+                raise MenuError(f"{where}: id must match {_ITEM_ID.pattern}")
+            if not isinstance(meta, dict):
+                raise MenuError(f"{where}: must be an object")
+            name, price = meta.get("name"), meta.get("price")
+            note, available = meta.get("note", ""), meta.get("available", True)
+            stock = meta.get("stock")
+            if not isinstance(name, str) or not name.strip():
+                raise MenuError(f"{where}: name is required")
+            if isinstance(price, bool) or not isinstance(price, int) or price < 0:
+                raise MenuError(f"{where}: price must be a non-negative integer")
+            if not isinstance(note, str) or not isinstance(available, bool):
+                raise MenuError(f"{where}: note must be a string, available a boolean")
+            if stock is not None and (isinstance(stock, bool) or not isinstance(stock, int) or stock < 0):
+                raise MenuError(f"{where}: stock must be a non-negative integer")
+            items[iid] = {"name": name.strip(), "price": price, "note": note, "available": available,
+                          "stock": stock}
+        out[scope] = items
+    return out
+
+def _qty_markup(scope: str, target: str) -> InlineKeyboardMarkup:
+    # Цифрова сітка лишається як є (комфорт швидкого вибору)
+    rows = [
+        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (1,2,3)],
+        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (4,5,6)],
+        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (7,8,9)],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="nav:back")],
+    ]
+    return InlineKeyboardMarkup(rows)
+
+class Catalog:
+    # Скомпільоване меню: таблиці цін і готові кнопки. Незмінне після створення,
+    # тож хендлери читають його без блокувань, а reload просто підміняє посилання.
+    __slots__ = ("items", "prices", "_check_buttons", "_qty")
+
+    def __init__(self, items: Dict[str, Dict[str, dict]]):
+        self.items = items
+        self.prices = {scope: {iid: m["price"] for iid, m in sect.items()} for scope, sect in items.items()}
+        self._check_buttons = {}
+        self._qty = {}
+        for scope, sect in items.items():
+            buttons = []
+            for iid, meta in sect.items():
+                if not meta["available"]:
+                    continue
+                data = f"{scope}:toggle:{iid}"
+                buttons.append((iid,
+                                InlineKeyboardButton(f"□ {meta['name']} — {meta['price']} грн", callback_data=data),
+                                InlineKeyboardButton(f"☑ {meta['name']} — {meta['price']} грн", callback_data=data)))
+                self._qty[(scope, iid)] = _qty_markup(scope, iid)
+            self._check_buttons[scope] = buttons
+
+    def orderable(self, scope: str, iid: str) -> bool:
+        meta = self.items.get(scope, {}).get(iid)
+        return bool(meta and meta["available"])
+
+    def queue(self, scope: str, selected: Set[str]) -> List[str]:
+        # Черга qty-кроків у порядку меню: обхід set залежить від hash seed процесу
+        return [iid for iid, meta in self.items.get(scope, {}).items() if iid in selected and meta["available"]]
+
+    def name(self, scope: str, iid: str) -> str:
+        meta = self.items.get(scope, {}).get(iid)
+        return meta["name"] if meta else iid
+
+    def kb_check(self, scope: str, selected: Set[str], with_continue=True) -> InlineKeyboardMarkup:
+        # Розпродані лімітовані позиції ховаємо (крім уже відмічених — щоб можна було зняти)
+        rows = [[on if iid in selected else off] for iid, off, on in self._check_buttons[scope]
+                if iid in selected or STOCK.available(scope, iid) != 0]
+        if with_continue:
+            rows.append([InlineKeyboardButton("Продовжити ▶️", callback_data=f"{scope}:continue")])
+        rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="nav:back")])
+        return InlineKeyboardMarkup(rows)
+
+    def kb_qty(self, scope: str, target: str) -> InlineKeyboardMarkup:
+        return self._qty.get((scope, target)) or _qty_markup(scope, target)
+
+_MENU = Catalog(validate_menu(DEFAULT_MENU))
+_MENU_STAMP = None
+
+def catalog() -> Catalog:
+    return _MENU
+
+def load_menu(path: Path) -> Catalog:
+    if path.suffix == ".toml":
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            raise MenuError(f"{path.name}: TOML menu needs Python 3.11+, use JSON instead") from None
+        raw = tomllib.loads(path.read_text(encoding="utf-8"))
+    else:
+        raw = json.loads(path.read_text(encoding="utf-8"))
+    return Catalog(validate_menu(raw))
+
+def reload_menu() -> bool:
+    # Викликається з JobQueue: парсинг і компіляція йдуть поза хендлерами
+    global _MENU, _MENU_STAMP
+    try:
+        st = MENU_FILE.stat()
+    except FileNotFoundError:
+        return False
+    stamp = (st.st_mtime_ns, st.st_size)
+    if stamp == _MENU_STAMP:
+        return False
+    _MENU_STAMP = stamp  # навіть невдалу версію не перечитуємо до наступної зміни
+    try:
+        cat = load_menu(MENU_FILE)
+    except (OSError, ValueError) as e:
+        log.error("Menu %s rejected, keeping previous: %s", MENU_FILE, e)
+        return False
+    STOCK.configure(cat)
+    _MENU = cat
+    log.info("Menu reloaded from %s (%d items)", MENU_FILE, sum(len(v) for v in cat.items.values()))
+    return True
+
+def job_reload_menu(ctx: CallbackContext):
+    reload_menu()
 
 # ───────────────────────── ORDER SEQ ─────────────────────────
 DATA_DIR = Path(__file__).parent
@@ -70,15 +409,124 @@ def _load_seq():
 def _save_seq(date, seq):
     SEQ_FILE.write_text(json.dumps({"date": date, "seq": seq}, ensure_ascii=False), encoding="utf-8")
 
+_SEQ_LOCK = threading.Lock()
+
 def next_order_no() -> str:
-    today = dt.datetime.now().strftime("%Y%m%d")
-    last, seq = _load_seq()
-    if last != today:
-        seq = 0
-    seq += 1
-    _save_seq(today, seq)
+    with _SEQ_LOCK:  # read-modify-write файлу з різних воркерів
+        today = dt.datetime.now().strftime("%Y%m%d")
+        last, seq = _load_seq()
+        if last != today:
+            seq = 0
+        seq += 1
+        _save_seq(today, seq)
     return f"T{today}-{seq:04d}"
 
+# ───────────────────────── STOCK ────────────────────────────
+# Лічильники лімітованих позицій: qty-вибір резервує, order:confirm списує,
+# очищення кошика / рестарт / прибирання сесії звільняють. Кожен лічильник має
+# власний лок, тож покупці різних позицій не заважають одне одному.
+STOCK_FILE = DATA_DIR / "stock_state.json"
+
+class StockCounter:
+    __slots__ = ("lock", "configured", "on_hand", "reserved")
+
+    def __init__(self, configured: int, on_hand: int):
+        self.lock = threading.Lock()
+        self.configured = configured
+        self.on_hand = on_hand
+        self.reserved = 0
+
+class StockLedger:
+    def __init__(self, path: Path):
+        self._path = path
+        self._file_lock = threading.Lock()
+        self._counters: Dict[str, StockCounter] = {}
+        self._saved = self._load()
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            return json.loads(self._path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # Знімок теж під локом файлу: інакше старіший знімок може записатись останнім
+        with self._file_lock:
+            state = {}
+            for key, c in list(self._counters.items()):
+                with c.lock:
+                    state[key] = {"configured": c.configured, "on_hand": c.on_hand}
+            # temp + os.replace: обірваний запис не лишить битого JSON, з якого
+            # configure скинув би лічильники до configured і перепродав склад
+            tmp = self._path.with_name(self._path.name + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+
+    def configure(self, cat: "Catalog"):
+        # Новий словник підміняється цілим; наявні лічильники зберігають резерви
+        counters = {}
+        for scope, sect in cat.items.items():
+            for iid, meta in sect.items():
+                stock = meta["stock"]
+                if stock is None:
+                    continue
+                key = f"{scope}:{iid}"
+                c = self._counters.get(key)
+                if c is None:
+                    saved = self._saved.get(key, {})
+                    on_hand = saved.get("on_hand", stock) if saved.get("configured") == stock else stock
+                    c = StockCounter(stock, on_hand)
+                elif c.configured != stock:
+                    with c.lock:
+                        c.configured = c.on_hand = stock
+                counters[key] = c
+        self._counters = counters
+
+    def is_limited(self, key: str) -> bool:
+        return key in self._counters
+
+    def available(self, scope: str, iid: str) -> Optional[int]:
+        c = self._counters.get(f"{scope}:{iid}")
+        return None if c is None else max(0, c.on_hand - c.reserved)
+
+    def reserve(self, key: str, qty: int) -> Optional[int]:
+        # None — зарезервовано, інакше — скільки є насправді
+        c = self._counters.get(key)
+        if c is None:
+            return None
+        with c.lock:
+            left = c.on_hand - c.reserved
+            if left < qty:
+                return max(0, left)
+            c.reserved += qty
+        return None
+
+    def release(self, key: str, qty: int):
+        c = self._counters.get(key)
+        if c is not None:
+            with c.lock:
+                c.reserved = max(0, c.reserved - qty)
+
+    def commit(self, key: str, qty: int):
+        c = self._counters.get(key)
+        if c is not None:
+            with c.lock:
+                c.reserved = max(0, c.reserved - qty)
+                c.on_hand = max(0, c.on_hand - qty)
+
+    def limited(self) -> Dict[str, tuple]:
+        out = {}
+        for key, c in list(self._counters.items()):
+            with c.lock:
+                out[key] = (c.on_hand, c.reserved)
+        return out
+
+STOCK = StockLedger(STOCK_FILE)
+STOCK.configure(catalog())
+
 # ───────────────────────── SESSION ──────────────────────────
 @dataclass
 class Session:
@@ -109,11 +557,158 @@ class Session:
     awaiting: Optional[str] = None   # 'addr' | 'phone' | 'comment'
     current_order_no: Optional[str] = None
 
+    last_active: float = field(default_factory=time.time)
+    cart_reminded: bool = False
+    reservations: Dict[str, int] = field(default_factory=dict)  # "scope:iid" -> qty
+    expired: List[str] = field(default_factory=list)            # назви, прибрані через TTL резерву
+
+_BASKETS = {
+    "shawarma": "basket_shawarma", "addons": "basket_addons", "sides": "basket_sides",
+    "desserts": "basket_desserts", "drinks": "basket_drinks",
+}
+
+NOT_ORDERABLE = -1  # позицію прибрали з меню, поки клієнт був на її qty-екрані
+
+def reserve_into_basket(ses: Session, scope: str, iid: str, qty: int) -> Optional[int]:
+    # None — додано; NOT_ORDERABLE — позиції вже немає в меню; число — скільки лишилось
+    if not catalog().orderable(scope, iid):
+        return NOT_ORDERABLE
+    key = f"{scope}:{iid}"
+    if STOCK.is_limited(key):
+        left = STOCK.reserve(key, qty)
+        if left is not None:
+            return left
+        ses.reservations[key] = ses.reservations.get(key, 0) + qty
+    basket = getattr(ses, _BASKETS[scope])
+    basket[iid] = basket.get(iid, 0) + qty
+    return None
+
+def release_reservations(ses: Session, keys=None):
+    for key in list(ses.reservations) if keys is None else keys:
+        qty = ses.reservations.pop(key, 0)
+        if qty:
+            STOCK.release(key, qty)
+
+def expire_reservations(ses: Session):
+    # TTL резерву минув: одиниці повертаються на склад, а лімітовані позиції
+    # прибираються з кошика — без резерву там нічого не лишилось
+    cat = catalog()
+    for key in list(ses.reservations):
+        scope, iid = key.split(":", 1)
+        if getattr(ses, _BASKETS[scope]).pop(iid, None):
+            ses.expired.append(cat.name(scope, iid))
+    release_reservations(ses)
+
+def commit_reservations(ses: Session):
+    if not ses.reservations:
+        return
+    for key, qty in ses.reservations.items():
+        STOCK.commit(key, qty)
+    ses.reservations.clear()
+    STOCK.save()
+
+def drop_unavailable(ses: Session) -> List[str]:
+    # Позиції, які прибрали з меню або позначили як sold out, поки сесія жила,
+    # а також лімітовані позиції без резерву (ліміт додали вже після вибору)
+    cat, dropped = catalog(), ses.expired[:]
+    ses.expired.clear()
+    for scope, attr in _BASKETS.items():
+        basket = getattr(ses, attr)
+        for iid in list(basket):
+            key = f"{scope}:{iid}"
+            if not cat.orderable(scope, iid):
+                del basket[iid]
+                release_reservations(ses, [key])
+                dropped.append(cat.name(scope, iid))
+                continue
+            if not STOCK.is_limited(key):
+                continue
+            reserved = ses.reservations.get(key, 0)
+            missing = basket[iid] - reserved
+            if missing > 0 and STOCK.reserve(key, missing) is not None:
+                if reserved:
+                    basket[iid] = reserved
+                else:
+                    del basket[iid]
+                dropped.append(cat.name(scope, iid))
+            elif missing > 0:
+                ses.reservations[key] = basket[iid]
+    return dropped
+
 def get_session(ctx: CallbackContext) -> Session:
     if "session" not in ctx.user_data:
         ctx.user_data["session"] = Session()
     return ctx.user_data["session"]
 
+# ───────────────────────── CONCURRENCY ──────────────────────
+# Хендлери виконуються на пулі воркерів, але в межах одного чату — строго в
+# порядку надходження: dispatcher-потік ставить апдейт у FIFO цього чату, а
+# чергу розбирає один воркер за раз (RLock сам по собі не FIFO — пізніший
+# апдейт міг би обігнати ранній). Смугастий лок за chat id лишається для
+# джобів, що чіпають Session у user_data (sweep). Реєстри в bot_data — звичайні
+# dict: поодинокі get/set/pop/setdefault атомарні під GIL, а обхід — по копії.
+class StripedLocks:
+    def __init__(self, stripes: int):
+        self._locks = [threading.RLock() for _ in range(max(1, stripes))]
+
+    def for_key(self, key) -> threading.RLock:
+        return self._locks[hash(key) % len(self._locks)]
+
+CHAT_LOCKS = StripedLocks(LOCK_STRIPES)
+
+class ChatQueues:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, deque] = {}   # chat id -> апдейти, що чекають воркера
+
+    def submit(self, key: int, fn, update, ctx):
+        # Викликається з dispatcher-потоку, тож порядок submit = порядок апдейтів
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append((fn, update, ctx))
+                return
+            self._pending[key] = deque([(fn, update, ctx)])
+        ctx.dispatcher.run_async(self._drain, key, ctx.dispatcher)
+
+    def _drain(self, key: int, dp):
+        while True:
+            with self._lock:
+                pending = self._pending[key]
+                if not pending:
+                    del self._pending[key]
+                    return
+                fn, update, ctx = pending.popleft()
+            try:
+                run_locked(key, fn, update, ctx)
+            except Exception as e:
+                dp.dispatch_error(update, e)
+
+    def depth(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._pending.values())
+
+CHAT_QUEUES = ChatQueues()
+
+def run_locked(key: int, fn, update, ctx):
+    with CHAT_LOCKS.for_key(key):
+        try:
+            return fn(update, ctx)
+        finally:
+            touch_session(update, ctx)
+
+def per_chat(fn, run_async: bool = True):
+    @wraps(fn)
+    def wrapper(update, ctx):
+        chat, user = update.effective_chat, update.effective_user
+        key = chat.id if chat else (user.id if user else None)
+        if key is None:
+            return ctx.dispatcher.run_async(fn, update, ctx, update=update) if run_async else fn(update, ctx)
+        if run_async:
+            return CHAT_QUEUES.submit(key, fn, update, ctx)
+        return run_locked(key, fn, update, ctx)
+    return wrapper
+
 # ───────────────────────── ORDERS REGISTRY (status + DM) ────
 def ensure_globals(ctx: CallbackContext):
     ctx.bot_data.setdefault("orders", {})              # order_no -> {...}
@@ -124,21 +719,367 @@ def ORDERS(ctx: CallbackContext) -> Dict[str, dict]:
     ensure_globals(ctx)
     return ctx.bot_data["orders"]
 
-def set_admin_wait_dm(ctx: CallbackContext, admin_id: int, order_no: str):
+# Очікування DM зберігаються як (order_no, час): застаріле не перехоплює текст.
+# Запис, читання й чистка йдуть під локом свого реєстру — у sweep це check-then-act.
+_WAIT_LOCKS = {"await_admin_dm": threading.Lock(), "await_user_dm": threading.Lock()}
+
+def _fresh_wait(entry) -> Optional[str]:
+    if entry and time.time() - entry[1] < AWAIT_TTL_MIN * 60:
+        return entry[0]
+    return None
+
+def _set_wait(ctx: CallbackContext, key: str, chat_id: int, order_no: str):
     ensure_globals(ctx)
-    ctx.bot_data["await_admin_dm"][admin_id] = order_no
+    with _WAIT_LOCKS[key]:
+        ctx.bot_data[key][chat_id] = (order_no, time.time())
 
-def pop_admin_wait_dm(ctx: CallbackContext, admin_id: int) -> Optional[str]:
+def _pop_wait(ctx: CallbackContext, key: str, chat_id: int) -> Optional[str]:
     ensure_globals(ctx)
-    return ctx.bot_data["await_admin_dm"].pop(admin_id, None)
+    with _WAIT_LOCKS[key]:
+        return _fresh_wait(ctx.bot_data[key].pop(chat_id, None))
+
+def prune_waits(bot_data: dict):
+    for key, lock in _WAIT_LOCKS.items():
+        waits = bot_data.get(key, {})
+        with lock:
+            for chat_id in [c for c, entry in waits.items() if _fresh_wait(entry) is None]:
+                del waits[chat_id]
+
+def set_admin_wait_dm(ctx: CallbackContext, admin_id: int, order_no: str):
+    _set_wait(ctx, "await_admin_dm", admin_id, order_no)
+
+def pop_admin_wait_dm(ctx: CallbackContext, admin_id: int) -> Optional[str]:
+    return _pop_wait(ctx, "await_admin_dm", admin_id)
 
 def set_user_wait_dm(ctx: CallbackContext, user_chat_id: int, order_no: str):
-    ensure_globals(ctx)
-    ctx.bot_data["await_user_dm"][user_chat_id] = order_no
+    _set_wait(ctx, "await_user_dm", user_chat_id, order_no)
 
 def pop_user_wait_dm(ctx: CallbackContext, user_chat_id: int) -> Optional[str]:
-    ensure_globals(ctx)
-    return ctx.bot_data["await_user_dm"].pop(user_chat_id, None)
+    return _pop_wait(ctx, "await_user_dm", user_chat_id)
+
+# ───────────────────────── KITCHEN METRICS ──────────────────
+STATUS_LABELS = {
+    "new": "🟡 Нове", "accept": "🟢 Прийнято", "cooking": "👨‍🍳 Готуємо",
+    "courier": "🚴 Курʼєр в дорозі", "done": "✅ Готово",
+}
+METRICS_HOURS = 24
+
+class LogHistogram:
+    # HDR-подібна гістограма: логарифмічні бакети з кроком 5% від 1 с до доби,
+    # фіксована памʼять незалежно від кількості замовлень.
+    __slots__ = ("counts", "n")
+    BASE = 1.05
+    SIZE = int(math.log(24 * 3600) / math.log(BASE)) + 2
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.n = 0
+
+    def add(self, seconds: float):
+        idx = 0 if seconds <= 1 else min(self.SIZE - 1, int(math.log(seconds) / math.log(self.BASE)) + 1)
+        self.counts[idx] += 1
+        self.n += 1
+
+    def merge(self, other: "LogHistogram"):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.n += other.n
+
+    def quantile(self, q: float) -> float:
+        rank, seen = q * self.n, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                return self.BASE ** (i - 0.5) if i else 1.0  # геометричний центр бакета
+        return 0.0
+
+class KitchenStats:
+    # Тривалість етапів між статусами адмін-панелі, окремо по кожній годині
+    def __init__(self, hours: int = METRICS_HOURS):
+        self._lock = threading.Lock()
+        self._hours: Dict[int, Dict[str, LogHistogram]] = {}
+        self._keep = hours
+
+    def _record(self, stage: str, seconds: float):
+        hour = int(time.time() // 3600)
+        bucket = self._hours.get(hour)
+        if bucket is None:
+            bucket = self._hours[hour] = {}
+            for old in [h for h in self._hours if h <= hour - self._keep]:
+                del self._hours[old]
+        bucket.setdefault(stage, LogHistogram()).add(seconds)
+
+    def transition(self, reg: dict, status: str):
+        now = time.monotonic()
+        with self._lock:
+            stamps = reg.setdefault("status_ts", {})
+            prev = reg.get("status")
+            reg["status"] = status
+            if status in stamps:
+                return  # повторне натискання / повернення назад — етап уже виміряно
+            stamps[status] = now
+            if prev in stamps:
+                self._record(f"{prev}>{status}", now - stamps[prev])
+            if status == "done" and "new" in stamps:
+                self._record("total", now - stamps["new"])
+
+    def summary(self, hours: int) -> Dict[str, LogHistogram]:
+        since = int(time.time() // 3600) - hours + 1
+        out: Dict[str, LogHistogram] = {}
+        with self._lock:
+            for hour, stages in self._hours.items():
+                if hour < since:
+                    continue
+                for stage, hist in stages.items():
+                    out.setdefault(stage, LogHistogram()).merge(hist)
+        return out
+
+KITCHEN = KitchenStats()
+
+def fmt_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}с"
+    if seconds < 3600:
+        return f"{seconds // 60}хв {seconds % 60}с"
+    return f"{seconds // 3600}год {seconds % 3600 // 60}хв"
+
+def stage_label(stage: str) -> str:
+    if stage == "total":
+        return "Від замовлення до готовності"
+    a, b = stage.split(">", 1)
+    return f"{STATUS_LABELS[a]} → {STATUS_LABELS[b]}"
+
+# ───────────────────────── RUNTIME INTROSPECTION ────────────
+# Усе вмикається першим /debug: до того хендлери платять одну перевірку прапорця,
+# а tracemalloc не запущений.
+DEBUG_TOP_N = 10
+
+class BusyMeter:
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self._busy = 0.0
+        self._mark = (time.monotonic(), 0.0)
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self, spent: float):
+        with self._lock:
+            self.in_flight -= 1
+            self._busy += spent
+
+    def utilization(self) -> Optional[float]:
+        # Середня кількість зайнятих хендлерами потоків з попереднього виклику
+        now = time.monotonic()
+        with self._lock:
+            was_active, self.active = self.active, True
+            last_t, last_busy = self._mark
+            self._mark = (now, self._busy)
+            busy = self._busy - last_busy
+        return busy / (now - last_t) if was_active and now > last_t else None
+
+    def stop(self):
+        # Хендлери знову платять лише перевірку прапорця; незавершені самі вийдуть з in_flight
+        with self._lock:
+            self.active = False
+
+BUSY = BusyMeter()
+
+def tracked(fn):
+    route = fn.__name__
+
+    @wraps(fn)
+    def wrapper(update, ctx):
+        meter, debug = BUSY.active, log.isEnabledFor(logging.DEBUG)
+        if not (meter or debug):
+            return fn(update, ctx)
+        if meter:
+            BUSY.enter()
+        t0 = time.monotonic()
+        try:
+            return fn(update, ctx)
+        finally:
+            spent = time.monotonic() - t0
+            if meter:
+                BUSY.leave(spent)
+            if debug:
+                chat = update.effective_chat
+                log.debug("handled", extra={"route": route, "chat_id": chat.id if chat else None,
+                                            "latency_ms": round(spent * 1000, 1)})
+    return wrapper
+
+def deep_sizeof(obj) -> int:
+    seen, stack, total = set(), [obj], 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            for k, v in list(o.items()):
+                stack.append(k); stack.append(v)
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(list(o))
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+    return total
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def fmt_bytes(n: Optional[int]) -> str:
+    if n is None:
+        return "n/a"
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГБ"
+
+_TRACE_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),)
+
+class TraceState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last: Optional[tracemalloc.Snapshot] = None
+
+    def diff(self, top_n: int) -> List[str]:
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.last = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+                return ["tracemalloc увімкнено, базовий знімок зроблено. Повторіть /debug trace."]
+            snap = tracemalloc.take_snapshot().filter_traces(_TRACE_FILTERS)
+            prev, self.last = self.last, snap
+        stats = snap.compare_to(prev, "lineno") if prev else snap.statistics("lineno")
+        return [str(st) for st in stats[:top_n]] or ["(змін немає)"]
+
+    def dump(self) -> Optional[Path]:
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snap = tracemalloc.take_snapshot()
+        path = Path(__file__).parent / f"tracemalloc-{dt.datetime.now():%Y%m%d-%H%M%S}.snap"
+        snap.dump(str(path))
+        return path
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.last = None
+
+TRACE = TraceState()
+
+# ───────────────────────── UPDATE RECORDER ──────────────────
+# Хендлер лише кладе Update у чергу; серіалізація, очищення PII і gzip —
+# у фоновому потоці. Переповнена черга відкидає апдейти, а не гальмує бота.
+_PII_NAME_KEYS = ("first_name", "last_name", "username", "phone_number", "title")
+_PII_DROP_KEYS = ("contact", "location", "venue", "photo", "document", "voice")
+
+class UpdateRecorder:
+    def __init__(self, directory: Path, rotate_bytes: int, keep: int, queue_size: int = 10000,
+                 rotate_seconds: float = RECORD_ROTATE_MIN * 60, flush_seconds: float = RECORD_FLUSH_SECONDS):
+        self.dir = directory
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_seconds = flush_seconds
+        self.keep = keep
+        self.dropped = 0
+        self._salt = os.urandom(16)
+        self._q: queue.Queue = queue.Queue(queue_size)
+        self._file = None
+        self._written = 0
+        self._opened = self._flushed = 0.0
+        self._thread = threading.Thread(target=self._run, name="update-recorder", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def handle(self, update: Update, ctx: CallbackContext):
+        try:
+            self._q.put_nowait((time.time(), update))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout=5)
+
+    def _pseudo(self, uid: int) -> int:
+        if uid == ADMIN_CHAT_ID:
+            return REPLAY_ADMIN_ID
+        digest = hmac.new(self._salt, str(uid).encode(), hashlib.sha256).digest()
+        return 1000 + int.from_bytes(digest[:6], "big")  # стабільно в межах процесу
+
+    def scrub(self, obj):
+        if isinstance(obj, list):
+            return [self.scrub(x) for x in obj]
+        if not isinstance(obj, dict):
+            return obj
+        out = {}
+        for key, value in obj.items():
+            if key in _PII_DROP_KEYS:
+                continue
+            if key in _PII_NAME_KEYS:
+                value = "x"
+            elif key in ("text", "caption") and isinstance(value, str) and not value.startswith("/"):
+                value = f"<text:{len(value)}>"
+            elif key in ("from", "chat", "user", "sender_chat") and isinstance(value, dict) and "id" in value:
+                value = dict(self.scrub(value), id=self._pseudo(value["id"]))
+            else:
+                value = self.scrub(value)
+            out[key] = value
+        return out
+
+    def _open(self):
+        if self._file:
+            self._file.close()
+        name = f"updates-{dt.datetime.now():%Y%m%d-%H%M%S-%f}.jsonl.gz"
+        self._file = gzip.open(self.dir / name, "wb")
+        self._written = 0
+        self._opened = time.monotonic()
+        for old in sorted(self.dir.glob("updates-*.jsonl.gz"))[:-self.keep]:
+            old.unlink(missing_ok=True)
+
+    def _flush(self):
+        # Z_SYNC_FLUSH: усе записане досі читається навіть з недописаного gzip
+        self._file.flush(zlib.Z_SYNC_FLUSH)
+        self._flushed = time.monotonic()
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+            ts, update = item
+            try:
+                line = (json.dumps({"t": ts, "update": self.scrub(update.to_dict())},
+                                   ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+                if (self._file is None or self._written >= self.rotate_bytes
+                        or time.monotonic() - self._opened >= self.rotate_seconds):
+                    self._open()
+                self._file.write(line)
+                self._written += len(line)
+                # Скидаємо, щойно черга спорожніла, а під сталим потоком — не рідше flush_seconds
+                if self._q.empty() or time.monotonic() - self._flushed >= self.flush_seconds:
+                    self._flush()
+            except Exception as e:
+                log.warning("Update recorder failed: %s", e)
+        if self._file:
+            self._file.close()
 
 # ───────────────────────── UI HELPERS ───────────────────────
 def _ack(update: Update):
@@ -167,25 +1108,11 @@ def kb_ship() -> InlineKeyboardMarkup:
 def kb_back() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="nav:back")]])
 
-def kb_check(options, selected: Set[str], scope: str, with_continue=True) -> InlineKeyboardMarkup:
-    rows = []
-    for oid, meta in options.items():
-        label = f"{'☑' if oid in selected else '□'} {meta['name']} — {meta['price']} грн"
-        rows.append([InlineKeyboardButton(label, callback_data=f"{scope}:toggle:{oid}")])
-    if with_continue:
-        rows.append([InlineKeyboardButton("Продовжити ▶️", callback_data=f"{scope}:continue")])
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="nav:back")])
-    return InlineKeyboardMarkup(rows)
+def kb_check(scope: str, selected: Set[str], with_continue=True) -> InlineKeyboardMarkup:
+    return catalog().kb_check(scope, selected, with_continue)
 
 def kb_qty(scope: str, target: str) -> InlineKeyboardMarkup:
-    # Цифрова сітка лишається як є (комфорт швидкого вибору)
-    rows = [
-        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (1,2,3)],
-        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (4,5,6)],
-        [InlineKeyboardButton(str(n), callback_data=f"{scope}:qty:{target}:{n}") for n in (7,8,9)],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="nav:back")],
-    ]
-    return InlineKeyboardMarkup(rows)
+    return catalog().kb_qty(scope, target)
 
 def kb_yesno(scope: str) -> InlineKeyboardMarkup:
     # По одному на рядок
@@ -235,29 +1162,25 @@ def kb_user_tracking(order_no: str) -> InlineKeyboardMarkup:
 def money(n: int) -> str: return f"{n} грн"
 
 def summarize(ses: Session) -> str:
+    cat = catalog()
     total = 0
     lines = ["Замовлення:"]
 
-    for iid, qty in ses.basket_shawarma.items():
-        meta = SHAWARMA_ITEMS[iid]; total += meta["price"] * qty
-        lines.append(f"Шаурма {meta['name']} — {qty} шт")
-
-    for sid, qty in ses.basket_sides.items():
-        meta = SIDES[sid]; total += meta["price"] * qty
-        lines.append(f"Сайд {meta['name']} — {qty} шт")
-
-    for did, qty in ses.basket_desserts.items():
-        meta = DESSERTS[did]; total += meta["price"] * qty
-        lines.append(f"Десерт {meta['name']} — {qty} шт")
-
-    for rid, qty in ses.basket_drinks.items():
-        meta = DRINKS[rid]; total += meta["price"] * qty
-        lines.append(f"Напій {meta['name']} — {qty} шт")
+    for scope, label in (("shawarma", "Шаурма"), ("sides", "Сайд"), ("desserts", "Десерт"), ("drinks", "Напій")):
+        for iid, qty in getattr(ses, _BASKETS[scope]).items():
+            meta = cat.items[scope].get(iid)
+            if meta is None:
+                continue  # позицію прибрали з меню
+            total += meta["price"] * qty
+            lines.append(f"{label} {meta['name']} — {qty} шт")
 
     if ses.basket_addons:
         lines += ["", "Додатки:"]
         for aid, qty in ses.basket_addons.items():
-            meta = ADDONS[aid]; total += meta["price"] * qty
+            meta = cat.items["addons"].get(aid)
+            if meta is None:
+                continue
+            total += meta["price"] * qty
             lines.append(f"{meta['name']} — {qty} пор.")
 
     lines.append("")
@@ -277,27 +1200,31 @@ def summarize(ses: Session) -> str:
     return "Номер замовлення: " + order_no + "\n\n" + "\n".join(lines)
 
 def cart_text(ses: Session) -> str:
+    cat = catalog()
     lines = ["<b>Кошик</b>"]
     empty = True
 
-    def add_group(title, items, catalog):
+    def item_line(scope, iid, qty, unit):
+        sold_out = "" if cat.orderable(scope, iid) else " (немає в наявності)"
+        return f"• {html.escape(cat.name(scope, iid))} — {qty} {unit}{sold_out}"
+
+    def add_group(title, items, scope):
         nonlocal empty
         if items:
             empty = False
             lines.append(f"\n<b>{title}</b>")
             for iid, qty in items.items():
-                meta = catalog[iid]
-                lines.append(f"• {meta['name']} — {qty} шт")
+                lines.append(item_line(scope, iid, qty, "шт"))
 
-    add_group("Шаурма",  ses.basket_shawarma, SHAWARMA_ITEMS)
-    add_group("Сайди",   ses.basket_sides,    SIDES)
-    add_group("Десерти", ses.basket_desserts, DESSERTS)
-    add_group("Напої",   ses.basket_drinks,   DRINKS)
+    add_group("Шаурма",  ses.basket_shawarma, "shawarma")
+    add_group("Сайди",   ses.basket_sides,    "sides")
+    add_group("Десерти", ses.basket_desserts, "desserts")
+    add_group("Напої",   ses.basket_drinks,   "drinks")
 
     if ses.basket_addons:
         lines.append(f"\n<b>Додатки</b>")
         for aid, qty in ses.basket_addons.items():
-            lines.append(f"• {ADDONS[aid]['name']} — {qty} пор.")
+            lines.append(item_line("addons", aid, qty, "пор."))
 
     if empty:
         lines.append("\n(Порожньо)")
@@ -322,15 +1249,15 @@ def render_by_tag(update: Update, ctx: CallbackContext, tag: str):
         "add_more":        lambda: render_add_more(update, ctx),
         "comment_wait":    lambda: render_comment_prompt(update, ctx),
         "summary":         lambda: render_summary(update, ctx),
-        "sides_select":    lambda: render_generic_select(update, ctx, SIDES, ses.sel_sides, "sides", "Обери сайди (можна кілька):"),
-        "desserts_select": lambda: render_generic_select(update, ctx, DESSERTS, ses.sel_desserts, "desserts", "Обери десерти (можна кілька):"),
-        "drinks_select":   lambda: render_generic_select(update, ctx, DRINKS, ses.sel_drinks, "drinks", "Обери напої (можна кілька):"),
+        "sides_select":    lambda: render_generic_select(update, ctx, ses.sel_sides, "sides", "Обери сайди (можна кілька):"),
+        "desserts_select": lambda: render_generic_select(update, ctx, ses.sel_desserts, "desserts", "Обери десерти (можна кілька):"),
+        "drinks_select":   lambda: render_generic_select(update, ctx, ses.sel_drinks, "drinks", "Обери напої (можна кілька):"),
     }
     if tag.startswith("shawarma_qty"): return render_sw_qty(update, ctx)
     if tag.startswith("addons_qty"):   return render_addons_qty(update, ctx)
-    if tag.startswith("sides_qty"):    return render_generic_qty(update, ctx, SIDES, ses.qty_sd_queue, "qty_sd_index", "sides", "Скільки")
-    if tag.startswith("desserts_qty"): return render_generic_qty(update, ctx, DESSERTS, ses.qty_ds_queue, "qty_ds_index", "desserts", "Скільки")
-    if tag.startswith("drinks_qty"):   return render_generic_qty(update, ctx, DRINKS, ses.qty_dr_queue, "qty_dr_index", "drinks", "Скільки")
+    if tag.startswith("sides_qty"):    return render_generic_qty(update, ctx, ses.qty_sd_queue, "qty_sd_index", "sides", "Скільки")
+    if tag.startswith("desserts_qty"): return render_generic_qty(update, ctx, ses.qty_ds_queue, "qty_ds_index", "desserts", "Скільки")
+    if tag.startswith("drinks_qty"):   return render_generic_qty(update, ctx, ses.qty_dr_queue, "qty_dr_index", "drinks", "Скільки")
     return mapping.get(tag, lambda: render_home(update, ctx, True))()
 
 # ───────────────────────── RENDERS ──────────────────────────
@@ -365,42 +1292,48 @@ def render_home(update: Update, ctx: CallbackContext, replace=False):
 def render_sw_select(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
     push_state(ses, "shawarma_select")
-    markup = kb_check(SHAWARMA_ITEMS, ses.sel_shawarma, "shawarma")
+    markup = kb_check("shawarma", ses.sel_shawarma)
     update.callback_query.edit_message_text("Оберіть шаурму (можна кілька):", reply_markup=markup)
 
-def render_sw_qty(update: Update, ctx: CallbackContext):
+def with_note(note: str, text: str) -> str:
+    return f"{note}\n\n{text}" if note else text
+
+def dropped_note(dropped: List[str]) -> str:
+    return "⚠️ Вже недоступно й прибрано з кошика: " + ", ".join(dropped) if dropped else ""
+
+def render_sw_qty(update: Update, ctx: CallbackContext, note: str = ""):
     ses = get_session(ctx)
     push_state(ses, f"shawarma_qty:{ses.qty_sw_index}")
     item_id = ses.qty_sw_queue[ses.qty_sw_index]
-    item = SHAWARMA_ITEMS[item_id]
     markup = kb_qty("shawarma", item_id)
-    update.callback_query.edit_message_text(f"Скільки «{item['name']}»?", reply_markup=markup)
+    update.callback_query.edit_message_text(with_note(note, f"Скільки «{catalog().name('shawarma', item_id)}»?"),
+                                            reply_markup=markup)
 
-def render_addons_yesno(update: Update, ctx: CallbackContext):
+def render_addons_yesno(update: Update, ctx: CallbackContext, note: str = ""):
     ses = get_session(ctx)
     push_state(ses, "addons_yesno")
     markup = kb_yesno("addons")
-    update.callback_query.edit_message_text("Чи потрібно щось додати в шаурму?", reply_markup=markup)
+    update.callback_query.edit_message_text(with_note(note, "Чи потрібно щось додати в шаурму?"), reply_markup=markup)
 
 def render_addons_select(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
     push_state(ses, "addons_select")
-    markup = kb_check(ADDONS, ses.sel_addons, "addons")
+    markup = kb_check("addons", ses.sel_addons)
     update.callback_query.edit_message_text("Оберіть додатки (можна кілька):", reply_markup=markup)
 
-def render_addons_qty(update: Update, ctx: CallbackContext):
+def render_addons_qty(update: Update, ctx: CallbackContext, note: str = ""):
     ses = get_session(ctx)
     push_state(ses, f"addons_qty:{ses.qty_add_index}")
     aid = ses.qty_add_queue[ses.qty_add_index]
-    addon = ADDONS[aid]
     markup = kb_qty("addons", aid)
-    update.callback_query.edit_message_text(f"Скільки порцій «{addon['name']}»?", reply_markup=markup)
+    update.callback_query.edit_message_text(with_note(note, f"Скільки порцій «{catalog().name('addons', aid)}»?"),
+                                            reply_markup=markup)
 
-def render_add_more(update: Update, ctx: CallbackContext):
+def render_add_more(update: Update, ctx: CallbackContext, note: str = ""):
     ses = get_session(ctx)
     push_state(ses, "add_more")
     markup = kb_yesno("addmore")
-    update.callback_query.edit_message_text("Додати щось ще до замовлення?", reply_markup=markup)
+    update.callback_query.edit_message_text(with_note(note, "Додати щось ще до замовлення?"), reply_markup=markup)
 
 def render_comment_prompt(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
@@ -412,27 +1345,39 @@ def render_comment_prompt(update: Update, ctx: CallbackContext):
 
 def render_summary(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
+    note = dropped_note(drop_unavailable(ses))
     push_state(ses, "summary")
     markup = kb_summary()
-    update.callback_query.edit_message_text(summarize(ses), reply_markup=markup, disable_web_page_preview=True)
+    update.callback_query.edit_message_text(with_note(note, summarize(ses)), reply_markup=markup,
+                                            disable_web_page_preview=True)
 
-def render_generic_select(update: Update, ctx: CallbackContext, options, selected, scope, title):
+def render_generic_select(update: Update, ctx: CallbackContext, selected, scope, title):
     ses = get_session(ctx)
     push_state(ses, f"{scope}_select")
-    markup = kb_check(options, selected, scope)
+    markup = kb_check(scope, selected)
     update.callback_query.edit_message_text(title, reply_markup=markup)
 
-def render_generic_qty(update: Update, ctx: CallbackContext, options, queue, index_attr, scope, title_prefix):
+def render_generic_qty(update: Update, ctx: CallbackContext, queue, index_attr, scope, title_prefix, note: str = ""):
     ses = get_session(ctx)
     idx = getattr(ses, index_attr)
     push_state(ses, f"{scope}_qty:{idx}")
     item_id = queue[idx]
-    item = options[item_id]
     markup = kb_qty(scope, item_id)
-    update.callback_query.edit_message_text(f"{title_prefix} «{item['name']}»?", reply_markup=markup)
+    update.callback_query.edit_message_text(with_note(note, f"{title_prefix} «{catalog().name(scope, item_id)}»?"),
+                                            reply_markup=markup)
+
+def stock_notes(scope: str, iid: str, left: Optional[int]) -> tuple:
+    # (повторити той самий крок, примітка) після невдалого резерву
+    if left == NOT_ORDERABLE:
+        return False, f"⚠️ Вже недоступно: {catalog().name(scope, iid)}"
+    if not left:
+        return False, (f"😔 «{catalog().name(scope, iid)}» щойно закінчилось." if left == 0 else "")
+    return True, f"Залишилось лише {left} шт."
 
 # ───────────────────────── COMMANDS ─────────────────────────
 def cmd_start(update: Update, ctx: CallbackContext):
+    if "session" in ctx.user_data:
+        release_reservations(ctx.user_data["session"])
     ctx.user_data["session"] = Session()
     render_delivery(update, ctx, False)
 
@@ -447,6 +1392,93 @@ def cmd_help(update: Update, ctx: CallbackContext):
     )
     update.message.reply_text(text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
+def cmd_kitchen(update: Update, ctx: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    depth = {k: 0 for k in STATUS_LABELS if k != "done"}
+    for reg in list(ORDERS(ctx).values()):
+        if reg.get("status") in depth:
+            depth[reg["status"]] += 1
+    lines = ["<b>Черга</b>"] + [f"{STATUS_LABELS[k]}: {n}" for k, n in depth.items()]
+    for title, hours in (("Поточна година", 1), (f"Останні {METRICS_HOURS} год", METRICS_HOURS)):
+        stats = KITCHEN.summary(hours)
+        lines.append(f"\n<b>{title}</b> (p50 / p90)")
+        if not stats:
+            lines.append("(даних ще немає)")
+        for stage, hist in sorted(stats.items(), key=lambda kv: kv[0] == "total"):
+            lines.append(f"{stage_label(stage)}: {fmt_duration(hist.quantile(0.5))} / "
+                         f"{fmt_duration(hist.quantile(0.9))} (n={hist.n})")
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+def cmd_debug(update: Update, ctx: CallbackContext):
+    # /debug — стан процесу; /debug trace [N] | dump — tracemalloc; /debug stop — вимкнути все
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    args = ctx.args or []
+    sub = args[0] if args else ""
+
+    if sub == "trace":
+        top_n = int(args[1]) if len(args) > 1 and args[1].isdigit() else DEBUG_TOP_N
+        text = "\n".join(TRACE.diff(top_n))
+        return update.message.reply_text(text[:4000])
+    if sub == "dump":
+        path = TRACE.dump()
+        return update.message.reply_text(f"Знімок збережено: {path}" if path else "Спершу /debug trace.")
+    if sub == "stop":
+        TRACE.stop()
+        BUSY.stop()
+        return update.message.reply_text("tracemalloc і вимір завантаження вимкнено.")
+
+    dp = ctx.dispatcher
+    sessions = [ud["session"] for ud in list(dp.user_data.values()) if "session" in ud]
+    ensure_globals(ctx)
+    bd = ctx.bot_data
+    async_queue = getattr(dp, "_Dispatcher__async_queue", None)
+    util = BUSY.utilization()
+    lines = [
+        "<b>Debug</b>",
+        f"RSS: {fmt_bytes(rss_bytes())}",
+        f"Сесії: {len(sessions)} (~{fmt_bytes(sum(deep_sizeof(x) for x in sessions))})",
+        f"ORDERS: {len(bd['orders'])} (~{fmt_bytes(deep_sizeof(bd['orders']))})",
+        f"DM очікування: адмін {len(bd['await_admin_dm'])}, клієнти {len(bd['await_user_dm'])}",
+        f"Черга оновлень: {dp.update_queue.qsize()}",
+        f"Воркери: {dp.workers}, run_async у черзі: {async_queue.qsize() if async_queue else 'n/a'}",
+        f"Апдейти в чергах чатів: {CHAT_QUEUES.depth()}",
+        f"Зайнято хендлерами: {BUSY.in_flight}, завантаження: "
+        + (f"{util:.2f} потоку" if util is not None else "вимір розпочато"),
+        f"Логи: у черзі {LOG_HANDLER.queue.qsize()}/{LOG_QUEUE_SIZE}, відкинуто {LOG_HANDLER.dropped}",
+        f"tracemalloc: {'on' if tracemalloc.is_tracing() else 'off'}",
+    ]
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+def cmd_stock(update: Update, ctx: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    cat = catalog()
+    lines = ["<b>Залишки</b> (вільно / на складі, в резерві)"]
+    for key, (on_hand, reserved) in sorted(STOCK.limited().items()):
+        scope, iid = key.split(":", 1)
+        lines.append(f"{html.escape(cat.name(scope, iid))}: {max(0, on_hand - reserved)} / {on_hand}, резерв {reserved}")
+    if len(lines) == 1:
+        lines.append("(лімітованих позицій немає — задайте \"stock\" у меню)")
+    update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+def cmd_net(update: Update, ctx: CallbackContext):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    req = ctx.bot.request
+    if not isinstance(req, PooledRequest):
+        return update.message.reply_text("Transport stats недоступні.")
+    st = req.stats()
+    update.message.reply_text(
+        "<b>HTTP transport</b>\n"
+        f"Пул: {st['pool_size']}\n"
+        f"Виклики API: {st['calls']} (ретраї {st['retries']}, невдалі {st['failures']})\n"
+        f"HTTP-запити: {st['http_requests']}, нові зʼєднання {st['new_connections']}, "
+        f"reuse {st['reused']}",
+        parse_mode=ParseMode.HTML
+    )
+
 # ───────────────────────── TEXT INPUTS ──────────────────────
 def fallback_text(update: Update, ctx: CallbackContext):
     ensure_globals(ctx)
@@ -480,6 +1512,8 @@ def fallback_text(update: Update, ctx: CallbackContext):
     # 3) Regular awaited inputs
     ses = get_session(ctx)
     txt = (update.message.text or "").strip()
+    if ses.awaiting and time.time() - ses.last_active > AWAIT_TTL_MIN * 60:
+        ses.awaiting = None  # клієнт давно пішов з кроку введення
 
     if ses.awaiting == "addr":
         ses.address = txt
@@ -497,7 +1531,9 @@ def fallback_text(update: Update, ctx: CallbackContext):
         ses.comment = txt
         ses.awaiting = None
         update.message.reply_text("Коментар додано ✅")
-        update.effective_chat.send_message(summarize(ses), reply_markup=kb_summary(), disable_web_page_preview=True)
+        note = dropped_note(drop_unavailable(ses))
+        update.effective_chat.send_message(with_note(note, summarize(ses)), reply_markup=kb_summary(),
+                                           disable_web_page_preview=True)
         push_state(ses, "summary")
         return
 
@@ -521,6 +1557,7 @@ def on_nav(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
 
     if data == "restart":
+        release_reservations(ses)
         ctx.user_data["session"] = Session()
         return render_delivery(update, ctx, True)
 
@@ -533,15 +1570,15 @@ def on_nav(update: Update, ctx: CallbackContext):
 
     if data == "sides":
         ses.sel_sides = set(); ses.qty_sd_queue = []; ses.qty_sd_index = 0
-        return render_generic_select(update, ctx, SIDES, ses.sel_sides, "sides", "Обери сайди (можна кілька):")
+        return render_generic_select(update, ctx, ses.sel_sides, "sides", "Обери сайди (можна кілька):")
 
     if data == "desserts":
         ses.sel_desserts = set(); ses.qty_ds_queue = []; ses.qty_ds_index = 0
-        return render_generic_select(update, ctx, DESSERTS, ses.sel_desserts, "desserts", "Обери десерти (можна кілька):")
+        return render_generic_select(update, ctx, ses.sel_desserts, "desserts", "Обери десерти (можна кілька):")
 
     if data == "drinks":
         ses.sel_drinks = set(); ses.qty_dr_queue = []; ses.qty_dr_index = 0
-        return render_generic_select(update, ctx, DRINKS, ses.sel_drinks, "drinks", "Обери напої (можна кілька):")
+        return render_generic_select(update, ctx, ses.sel_drinks, "drinks", "Обери напої (можна кілька):")
 
     if data == "back":
         if not ses.history:
@@ -563,22 +1600,25 @@ def on_sw(update: Update, ctx: CallbackContext):
         oid = parts[1]
         if oid in ses.sel_shawarma: ses.sel_shawarma.remove(oid)
         else: ses.sel_shawarma.add(oid)
-        markup = kb_check(SHAWARMA_ITEMS, ses.sel_shawarma, "shawarma")
+        markup = kb_check("shawarma", ses.sel_shawarma)
         return update.callback_query.edit_message_reply_markup(markup)
 
     if action == "continue":
-        if not ses.sel_shawarma:
+        queue = catalog().queue("shawarma", ses.sel_shawarma)
+        if not queue:
             return update.callback_query.answer("Виберіть хоча б одну позицію.", show_alert=True)
-        ses.qty_sw_queue = list(ses.sel_shawarma); ses.qty_sw_index = 0
+        ses.qty_sw_queue = queue; ses.qty_sw_index = 0
         return render_sw_qty(update, ctx)
 
     if action == "qty":
         item_id = parts[1]; qty = int(parts[2])
-        ses.basket_shawarma[item_id] = ses.basket_shawarma.get(item_id, 0) + qty
+        retry, note = stock_notes("shawarma", item_id, reserve_into_basket(ses, "shawarma", item_id, qty))
+        if retry:
+            return render_sw_qty(update, ctx, note)
         if ses.qty_sw_index + 1 < len(ses.qty_sw_queue):
-            ses.qty_sw_index += 1; return render_sw_qty(update, ctx)
+            ses.qty_sw_index += 1; return render_sw_qty(update, ctx, note)
         else:
-            return render_addons_yesno(update, ctx)
+            return render_addons_yesno(update, ctx, note)
 
 def on_addons(update: Update, ctx: CallbackContext):
     _ack(update)
@@ -598,22 +1638,25 @@ def on_addons(update: Update, ctx: CallbackContext):
         aid = parts[1]
         if aid in ses.sel_addons: ses.sel_addons.remove(aid)
         else: ses.sel_addons.add(aid)
-        markup = kb_check(ADDONS, ses.sel_addons, "addons")
+        markup = kb_check("addons", ses.sel_addons)
         return update.callback_query.edit_message_reply_markup(markup)
 
     if action == "continue":
-        if not ses.sel_addons:
+        queue = catalog().queue("addons", ses.sel_addons)
+        if not queue:
             return render_add_more(update, ctx)
-        ses.qty_add_queue = list(ses.sel_addons); ses.qty_add_index = 0
+        ses.qty_add_queue = queue; ses.qty_add_index = 0
         return render_addons_qty(update, ctx)
 
     if action == "qty":
         aid = parts[1]; qty = int(parts[2])
-        ses.basket_addons[aid] = ses.basket_addons.get(aid, 0) + qty
+        retry, note = stock_notes("addons", aid, reserve_into_basket(ses, "addons", aid, qty))
+        if retry:
+            return render_addons_qty(update, ctx, note)
         if ses.qty_add_index + 1 < len(ses.qty_add_queue):
-            ses.qty_add_index += 1; return render_addons_qty(update, ctx)
+            ses.qty_add_index += 1; return render_addons_qty(update, ctx, note)
         else:
-            return render_add_more(update, ctx)
+            return render_add_more(update, ctx, note)
 
 def on_comment(update: Update, ctx: CallbackContext):
     _ack(update)
@@ -641,6 +1684,7 @@ def on_cart(update: Update, ctx: CallbackContext):
         return update.callback_query.edit_message_text(cart_text(ses), parse_mode=ParseMode.HTML, reply_markup=markup)
 
     if q == "clear":
+        release_reservations(ses)
         ses.basket_shawarma.clear(); ses.basket_addons.clear()
         ses.basket_sides.clear();    ses.basket_desserts.clear(); ses.basket_drinks.clear()
         return update.callback_query.edit_message_text(
@@ -650,6 +1694,16 @@ def on_cart(update: Update, ctx: CallbackContext):
 
 def finalize_order(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
+    if ses.current_order_no in ORDERS(ctx):
+        return  # повторне натискання «Підтвердити»
+    dropped = drop_unavailable(ses)
+    if dropped:
+        # Меню змінилось, поки клієнт збирав кошик — показуємо оновлений підсумок
+        push_state(ses, "summary")
+        return update.callback_query.edit_message_text(
+            with_note(dropped_note(dropped), summarize(ses)),
+            reply_markup=kb_summary(), disable_web_page_preview=True
+        )
     order_no = ses.current_order_no or next_order_no()
     ses.current_order_no = order_no
 
@@ -670,7 +1724,8 @@ def finalize_order(update: Update, ctx: CallbackContext):
         admin_msg_id = m.message_id
 
     # 2) Customer tracking message (with reply-to-admin button)
-    user_msg = update.callback_query.message.edit_text(
+    # (edit може повернути True замість Message, якщо спрацював повтор — id беремо з query)
+    update.callback_query.message.edit_text(
         f"{summary_text}\n\nСтатус: 🟡 Нове — {ts}",
         reply_markup=kb_user_tracking(order_no)
     )
@@ -679,17 +1734,22 @@ def finalize_order(update: Update, ctx: CallbackContext):
     reg = ORDERS(ctx)
     reg[order_no] = {
         "user_chat_id": update.effective_chat.id,
-        "user_status_msg_id": user_msg.message_id,
+        "user_status_msg_id": update.callback_query.message.message_id,
         "admin_msg_id": admin_msg_id or 0,
         "summary_text": summary_text,
     }
+    # Списуємо склад лише для зареєстрованого замовлення: якщо Bot API впав вище,
+    # резерв лишається в сесії й повторне «Підтвердити» не спише його вдруге
+    commit_reservations(ses)
+    KITCHEN.transition(reg[order_no], "new")
+    log.info("order created", extra={"order_no": order_no, "chat_id": update.effective_chat.id, "status": "new"})
 
 def on_order(update: Update, ctx: CallbackContext):
     _ack(update)
     if update.callback_query.data == "order:confirm":
         return finalize_order(update, ctx)
 
-def on_generic(update: Update, ctx: CallbackContext, options, selected: Set[str],
+def on_generic(update: Update, ctx: CallbackContext, selected: Set[str],
                queue_attr: str, index_attr: str, basket: Dict[str, int], scope: str):
     _ack(update)
     data  = update.callback_query.data.split(":", 1)[1]
@@ -701,47 +1761,45 @@ def on_generic(update: Update, ctx: CallbackContext, options, selected: Set[str]
         oid = parts[1]
         if oid in selected: selected.remove(oid)
         else: selected.add(oid)
-        markup = kb_check(options, selected, scope)
+        markup = kb_check(scope, selected)
         return update.callback_query.edit_message_reply_markup(markup)
 
     if action == "continue":
-        if not selected:
+        queue = catalog().queue(scope, selected)
+        if not queue:
             return update.callback_query.answer("Виберіть хоча б одну позицію.", show_alert=True)
-        setattr(ses, queue_attr, list(selected))
+        setattr(ses, queue_attr, queue)
         setattr(ses, index_attr, 0)
         if scope == "sides":
-            return render_generic_qty(update, ctx, options, ses.qty_sd_queue, "qty_sd_index", "sides", "Скільки")
+            return render_generic_qty(update, ctx, ses.qty_sd_queue, "qty_sd_index", "sides", "Скільки")
         if scope == "desserts":
-            return render_generic_qty(update, ctx, options, ses.qty_ds_queue, "qty_ds_index", "desserts", "Скільки")
+            return render_generic_qty(update, ctx, ses.qty_ds_queue, "qty_ds_index", "desserts", "Скільки")
         if scope == "drinks":
-            return render_generic_qty(update, ctx, options, ses.qty_dr_queue, "qty_dr_index", "drinks", "Скільки")
+            return render_generic_qty(update, ctx, ses.qty_dr_queue, "qty_dr_index", "drinks", "Скільки")
 
     if action == "qty":
         item_id = parts[1]; qty = int(parts[2])
-        basket[item_id] = basket.get(item_id, 0) + qty
+        retry, note = stock_notes(scope, item_id, reserve_into_basket(ses, scope, item_id, qty))
         idx = getattr(ses, index_attr); queue = getattr(ses, queue_attr)
+        if retry:
+            return render_generic_qty(update, ctx, queue, index_attr, scope, "Скільки", note)
         if idx + 1 < len(queue):
             setattr(ses, index_attr, idx + 1)
-            if scope == "sides":
-                return render_generic_qty(update, ctx, options, ses.qty_sd_queue, "qty_sd_index", "sides", "Скільки")
-            elif scope == "desserts":
-                return render_generic_qty(update, ctx, options, ses.qty_ds_queue, "qty_ds_index", "desserts", "Скільки")
-            elif scope == "drinks":
-                return render_generic_qty(update, ctx, options, ses.qty_dr_queue, "qty_dr_index", "drinks", "Скільки")
+            return render_generic_qty(update, ctx, queue, index_attr, scope, "Скільки", note)
         else:
-            return render_add_more(update, ctx)
+            return render_add_more(update, ctx, note)
 
 def on_sides(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
-    return on_generic(update, ctx, SIDES, ses.sel_sides, "qty_sd_queue", "qty_sd_index", ses.basket_sides, "sides")
+    return on_generic(update, ctx, ses.sel_sides, "qty_sd_queue", "qty_sd_index", ses.basket_sides, "sides")
 
 def on_desserts(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
-    return on_generic(update, ctx, DESSERTS, ses.sel_desserts, "qty_ds_queue", "qty_ds_index", ses.basket_desserts, "desserts")
+    return on_generic(update, ctx, ses.sel_desserts, "qty_ds_queue", "qty_ds_index", ses.basket_desserts, "desserts")
 
 def on_drinks(update: Update, ctx: CallbackContext):
     ses = get_session(ctx)
-    return on_generic(update, ctx, DRINKS, ses.sel_drinks, "qty_dr_queue", "qty_dr_index", ses.basket_drinks, "drinks")
+    return on_generic(update, ctx, ses.sel_drinks, "qty_dr_queue", "qty_dr_index", ses.basket_drinks, "drinks")
 
 def on_admin_status(update: Update, ctx: CallbackContext):
     _ack(update)
@@ -749,8 +1807,7 @@ def on_admin_status(update: Update, ctx: CallbackContext):
         return update.callback_query.answer("Недостатньо прав", show_alert=True)
 
     _, order_no, action = update.callback_query.data.split(":", 2)
-    status_map = {"accept":"🟢 Прийнято","cooking":"👨‍🍳 Готуємо","courier":"🚴 Курʼєр в дорозі","done":"✅ Готово"}
-    status = status_map.get(action, "🟡 Нове")
+    status = STATUS_LABELS.get(action, STATUS_LABELS["new"])
     ts = now_str()
 
     # Update admin panel text and keep buttons
@@ -762,6 +1819,9 @@ def on_admin_status(update: Update, ctx: CallbackContext):
 
     # Notify / update the user
     order_reg = ORDERS(ctx).get(order_no)
+    if order_reg and action in STATUS_LABELS:
+        KITCHEN.transition(order_reg, action)
+    log.info("order status", extra={"order_no": order_no, "status": action})
     if order_reg and order_reg.get("user_chat_id") and order_reg.get("user_status_msg_id"):
         # edit customer's tracking message
         try:
@@ -773,7 +1833,7 @@ def on_admin_status(update: Update, ctx: CallbackContext):
                 reply_markup=kb_user_tracking(order_no)
             )
         except Exception as e:
-            log.warning("Failed to edit user status message: %s", e)
+            log.warning("Failed to edit user status message: %s", e, extra={"order_no": order_no})
         # send separate notification message (mask + timestamp)
         try:
             ctx.bot.send_message(
@@ -781,7 +1841,7 @@ def on_admin_status(update: Update, ctx: CallbackContext):
                 text=f"Статус вашого замовлення змінено на: {status} — {ts}"
             )
         except Exception as e:
-            log.warning("Failed to send separate status message: %s", e)
+            log.warning("Failed to send separate status message: %s", e, extra={"order_no": order_no})
 
 def on_admin_msg(update: Update, ctx: CallbackContext):
     _ack(update)
@@ -801,13 +1861,135 @@ def on_user_msg(update: Update, ctx: CallbackContext):
     update.callback_query.answer("Напишіть повідомлення адміну…")
     update.callback_query.edit_message_reply_markup(kb_user_tracking(order_no))
 
+# ───────────────────────── IDLE SWEEP ───────────────────────
+class IdleWheel:
+    # Колесо часу з хвилинними слотами: кожна активність кладе user id у слот
+    # поточної хвилини. Sweep обходить лише слоти, що вже «дозріли», і перевіряє
+    # справжній last_active — застарілі записи просто відкидаються.
+    def __init__(self, slot_seconds: int = 60):
+        self.slot_seconds = slot_seconds
+        self._lock = threading.Lock()
+        self._slots: Dict[int, Set[int]] = {}
+        self._cursors: Dict[str, int] = {}
+
+    def touch(self, key: int, now: float):
+        slot = int(now // self.slot_seconds)
+        with self._lock:
+            self._slots.setdefault(slot, set()).add(key)
+
+    def due(self, name: str, cutoff: float, pop: bool = False) -> Set[int]:
+        # Ключі зі слотів до cutoff, які курсор `name` ще не бачив
+        end = int(cutoff // self.slot_seconds)
+        out: Set[int] = set()
+        with self._lock:
+            if not self._slots:
+                return out
+            start = self._cursors.get(name, min(self._slots))
+            for slot in range(start, end):
+                keys = self._slots.pop(slot, None) if pop else self._slots.get(slot)
+                if keys:
+                    out |= keys
+            self._cursors[name] = max(start, end)
+        return out
+
+IDLE = IdleWheel()
+
+def touch_session(update: Update, ctx: CallbackContext):
+    user = update.effective_user
+    ses = ctx.user_data.get("session") if user and ctx.user_data is not None else None
+    if ses is None:
+        return
+    ses.last_active = time.time()
+    ses.cart_reminded = False
+    IDLE.touch(user.id, ses.last_active)
+
+def _has_cart(ses: Session) -> bool:
+    return any(getattr(ses, attr) for attr in _BASKETS.values())
+
+def job_sweep_sessions(ctx: CallbackContext):
+    dp, now = ctx.dispatcher, time.time()
+    orders = dp.bot_data.get("orders", {})
+
+    if CART_REMINDER_MIN > 0:
+        remind = []
+        for uid in IDLE.due("remind", now - CART_REMINDER_MIN * 60):
+            with CHAT_LOCKS.for_key(uid):
+                ses = dp.user_data.get(uid, {}).get("session")
+                if (ses and not ses.cart_reminded and _has_cart(ses)
+                        and now - ses.last_active >= CART_REMINDER_MIN * 60
+                        and ses.current_order_no not in orders):
+                    ses.cart_reminded = True
+                    remind.append(uid)
+        # Пачками по REMINDERS_PER_SEC на секунду, щоб не впертись у ліміти Bot API
+        for i in range(0, len(remind), REMINDERS_PER_SEC):
+            ctx.job_queue.run_once(job_send_reminders, when=i // REMINDERS_PER_SEC,
+                                   context=remind[i:i + REMINDERS_PER_SEC])
+
+    if RESERVE_TTL_MIN > 0:
+        expired, ttl = 0, RESERVE_TTL_MIN * 60
+        for uid in IDLE.due("reserve", now - ttl):
+            with CHAT_LOCKS.for_key(uid):
+                ses = dp.user_data.get(uid, {}).get("session")
+                if (ses and ses.reservations and now - ses.last_active >= ttl
+                        and ses.current_order_no not in orders):
+                    expire_reservations(ses)
+                    expired += 1
+        if expired:
+            log.info("Released stock reservations of %d idle sessions", expired)
+
+    evicted = 0
+    ttl = SESSION_IDLE_HOURS * 3600
+    for uid in IDLE.due("evict", now - ttl, pop=True):
+        with CHAT_LOCKS.for_key(uid):
+            ud = dp.user_data.get(uid)
+            ses = ud.get("session") if ud else None
+            if ses and now - ses.last_active >= ttl:
+                release_reservations(ses)
+                del ud["session"]
+                if not ud:
+                    dp.user_data.pop(uid, None)
+                evicted += 1
+
+    prune_waits(dp.bot_data)
+
+    if evicted:
+        log.info("Evicted %d idle sessions", evicted)
+
+def job_send_reminders(ctx: CallbackContext):
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("🧺 Кошик", callback_data="cart:open")]])
+    for uid in ctx.job.context:
+        try:
+            ctx.bot.send_message(uid, "Ви залишили товари в кошику 🧺 Оформимо?", reply_markup=markup)
+        except Exception as e:
+            log.warning("Cart reminder failed: %s", e, extra={"chat_id": uid})
+
 # ───────────────────────── MAIN ─────────────────────────────
 def main():
-    updater = Updater(TOKEN, use_context=True)
+    updater = Updater(bot=make_bot(), use_context=True, workers=WORKERS)
     dp = updater.dispatcher
 
+    reload_menu()
+    updater.job_queue.run_repeating(job_reload_menu, interval=MENU_POLL_SECONDS, first=MENU_POLL_SECONDS)
+    updater.job_queue.run_repeating(job_sweep_sessions, interval=SWEEP_SECONDS, first=SWEEP_SECONDS)
+    register_handlers(dp)
+
+    if RECORD_DIR:
+        recorder = UpdateRecorder(Path(RECORD_DIR), int(RECORD_ROTATE_MB * 1024 * 1024), RECORD_KEEP)
+        dp.add_handler(TypeHandler(Update, recorder.handle), group=-1)
+        log.info("Recording updates to %s", RECORD_DIR)
+
+    log.info("Starting bot polling (PTB 13.x, status+DM, timestamps, 1btn/row)...")
+    updater.start_polling(timeout=POLL_TIMEOUT, drop_pending_updates=True)
+    updater.idle()
+
+def register_handlers(dp, run_async: bool = True):
+    # Також використовується replay_updates.py (там run_async=False, для детермінізму)
     dp.add_handler(CommandHandler("start", cmd_start))
     dp.add_handler(CommandHandler("help",  cmd_help))
+    dp.add_handler(CommandHandler("net",   cmd_net))
+    dp.add_handler(CommandHandler("kitchen", cmd_kitchen))
+    dp.add_handler(CommandHandler("debug", cmd_debug))
+    dp.add_handler(CommandHandler("stock", cmd_stock))
 
     dp.add_handler(CallbackQueryHandler(on_shipping, pattern=r"^ship:"))
     dp.add_handler(CallbackQueryHandler(on_nav,      pattern=r"^nav:"))
@@ -826,9 +2008,11 @@ def main():
 
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, fallback_text))
 
-    log.info("Starting bot polling (PTB 13.x, status+DM, timestamps, 1btn/row)...")
-    updater.start_polling(drop_pending_updates=True)
-    updater.idle()
+    for handlers in dp.handlers.values():
+        for h in handlers:
+            # Асинхронність дає per_chat (черга чату), сам хендлер — синхронний
+            h.callback = per_chat(tracked(h.callback), run_async)
+            h.run_async = False
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Перевірка HTTP-транспорту (PooledRequest) проти локального фейкового Bot API:
+# ретраї 5xx лише для ідемпотентних методів, send* не повторюється, connect-помилки
+# повторюються для всіх, повтор edit* після «загубленої» відповіді не стає
+# помилкою, а keep-alive пул перевикористовує зʼєднання (лічильники /net).
+#
+#   python check_transport.py
+from __future__ import annotations
+
+import json, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:transport")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import bot_ptb13 as bot  # noqa: E402
+from telegram.error import NetworkError  # noqa: E402
+from telegram.ext import ExtBot  # noqa: E402
+
+READ_TIMEOUT = 0.5
+RETRIES = 3
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    # Сценарій: method -> список дій на наступні запити; далі — звичайний успіх
+    protocol_version = "HTTP/1.1"
+    script = {}
+    hits = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # клієнт уже відвалився по read timeout — так і задумано
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.hits[method] = self.hits.get(method, 0) + 1
+            steps = self.script.get(method)
+            action = steps.pop(0) if steps else ("ok",)
+        if action[0] == "status":
+            return self._reply(action[1], {"ok": False, "error_code": action[1], "description": action[2]})
+        if action[0] == "slow":
+            time.sleep(action[1])  # «сервер» застосував виклик, але відповідь запізнилась
+        result = {"id": 42, "is_bot": True, "first_name": "fake", "username": "fake_bot"} if method == "getMe" else {
+            "message_id": 7, "date": int(time.time()), "chat": {"id": 5, "type": "private"}, "text": "x"}
+        self._reply(200, {"ok": True, "result": result})
+
+def make_client(base_url: str) -> ExtBot:
+    request = bot.PooledRequest(con_pool_size=4, connect_timeout=0.5, read_timeout=READ_TIMEOUT,
+                                poll_connect_timeout=0.5, retries=RETRIES, backoff=0.01, backoff_cap=0.05)
+    return ExtBot(os.environ["TELEGRAM_TOKEN"], base_url=base_url, request=request)
+
+def case(name: str, script: dict, call, expect_ok: bool, expect_hits: dict, expect_stats: dict, base_url: str):
+    FakeBotAPI.script = {m: list(steps) for m, steps in script.items()}
+    FakeBotAPI.hits = {}
+    client = make_client(base_url)
+    try:
+        call(client)
+        ok, err = True, ""
+    except NetworkError as e:
+        ok, err = False, f" ({type(e).__name__}: {e})"
+    stats = client.request.stats()
+    problems = []
+    if ok != expect_ok:
+        problems.append(f"expected {'success' if expect_ok else 'failure'}{err}")
+    for method, n in expect_hits.items():
+        if FakeBotAPI.hits.get(method, 0) != n:
+            problems.append(f"{method} hit {FakeBotAPI.hits.get(method, 0)}x, expected {n}")
+    for key, n in expect_stats.items():
+        if stats[key] != n:
+            problems.append(f"stats[{key}]={stats[key]}, expected {n}")
+    print(f"{'ok  ' if not problems else 'FAIL'} {name}: hits {FakeBotAPI.hits}, "
+          f"retries {stats['retries']}, failures {stats['failures']}, "
+          f"http {stats['http_requests']}, new conns {stats['new_connections']}, reused {stats['reused']}")
+    for p in problems:
+        print(f"     {p}")
+    return problems
+
+def main():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{srv.server_port}/bot"
+    dead = "http://127.0.0.1:1/bot"  # нічого не слухає: connection refused
+    bad_gateway = ("status", 502, "Bad Gateway")
+
+    problems = []
+    problems += case("edit retried on 5xx", {"editMessageText": [bad_gateway, bad_gateway]},
+                     lambda c: c.edit_message_text("x", chat_id=5, message_id=7),
+                     True, {"editMessageText": 3}, {"retries": 2, "failures": 0}, url)
+    problems += case("send not retried on 5xx", {"sendMessage": [bad_gateway]},
+                     lambda c: c.send_message(5, "x"),
+                     False, {"sendMessage": 1}, {"retries": 0, "failures": 1}, url)
+    problems += case("send not retried on read timeout", {"sendMessage": [("slow", READ_TIMEOUT * 3)]},
+                     lambda c: c.send_message(5, "x"),
+                     False, {"sendMessage": 1}, {"retries": 0, "failures": 1}, url)
+    problems += case("edit landed, reply lost -> not modified = success",
+                     {"editMessageText": [("slow", READ_TIMEOUT * 3),
+                                          ("status", 400, "Bad Request: message is not modified")]},
+                     lambda c: c.edit_message_text("x", chat_id=5, message_id=7),
+                     True, {"editMessageText": 2}, {"retries": 1, "failures": 0}, url)
+    problems += case("not modified on first attempt stays an error",
+                     {"editMessageText": [("status", 400, "Bad Request: message is not modified")]},
+                     lambda c: c.edit_message_text("x", chat_id=5, message_id=7),
+                     False, {"editMessageText": 1}, {"retries": 0, "failures": 1}, url)
+    problems += case("connect error retried for send", {},
+                     lambda c: c.send_message(5, "x"),
+                     False, {}, {"retries": RETRIES, "failures": 1}, dead)
+    problems += case("keep-alive reuse", {},
+                     lambda c: [c.get_me() for _ in range(10)],
+                     True, {"getMe": 10}, {"http_requests": 10, "new_connections": 1, "reused": 9}, url)
+
+    srv.shutdown()
+    print("FAIL" if problems else "OK")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Replay апдейтів, записаних ботом з RECORD_DIR, через ті самі хендлери проти
+# stub-бота. Рахує throughput і латентність, зберігає згенеровані API-виклики
+# і порівнює їх з baseline від іншої збірки.
+#
+#   python replay_updates.py records/ --calls-out new.jsonl --baseline old.jsonl
+#   python replay_updates.py records/ --menu menu.json   # меню, що діяло під час запису
+#   python replay_updates.py records/updates-….jsonl.gz --speed 1   # в оригінальному темпі
+from __future__ import annotations
+
+import argparse, gzip, itertools, json, os, re, sys, tempfile, time, zlib
+from pathlib import Path
+from queue import Queue
+
+# Бот читає env під час імпорту: фіктивний токен і той самий id адміна, під яким
+# UpdateRecorder записує адмінські апдейти (REPLAY_ADMIN_ID).
+os.environ["TELEGRAM_TOKEN"] = "123456:replay"
+os.environ["ADMIN_CHAT_ID"] = "1"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import bot_ptb13 as bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Dispatcher, ExtBot  # noqa: E402
+from telegram.utils.request import Request  # noqa: E402
+
+_TS = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}")
+_ORDER_DATE = re.compile(r"T\d{8}-")
+
+class StubRequest(Request):
+    # Замість HTTP: запамʼятовує виклик і повертає правдоподібну відповідь
+    __slots__ = ("calls", "_msg_ids")
+
+    def __init__(self):
+        super().__init__(con_pool_size=1)
+        self.calls = []
+        self._msg_ids = itertools.count(100000)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        self.calls.append((method, dict(data or {})))
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return {
+                "message_id": int(data.get("message_id") or next(self._msg_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id") or 0), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        return True
+
+def mask(value):
+    # Рекурсивно: дата в номері замовлення сидить і в callback_data клавіатур
+    if isinstance(value, str):
+        return _ORDER_DATE.sub("T<date>-", _TS.sub("<ts>", value))
+    if isinstance(value, dict):
+        return {k: mask(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [mask(v) for v in value]
+    return value
+
+def normalize(method: str, data: dict) -> dict:
+    # Прибирає те, що легітимно відрізняється між запусками: час і дату в номері замовлення
+    out = {"method": method}
+    for key, value in sorted(data.items()):
+        if key == "reply_markup" and isinstance(value, str):
+            value = json.loads(value)
+        out[key] = mask(value)
+    return out
+
+def read_records(paths):
+    files = []
+    for p in map(Path, paths):
+        files += sorted(p.glob("updates-*.jsonl.gz")) if p.is_dir() else [p]
+    for f in files:
+        # Файл, який писався під час kill -9, обривається без gzip-трейлера (а то й
+        # посеред рядка): беремо все, що встигло скинутись на диск
+        try:
+            with gzip.open(f, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    if line.strip() and line.endswith("\n"):
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            print(f"warning: {f.name} is truncated ({e}), replaying what was read", file=sys.stderr)
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded updates against a stub bot.")
+    ap.add_argument("logs", nargs="+", help="updates-*.jsonl.gz files or directories")
+    ap.add_argument("--speed", type=float, default=0.0,
+                    help="0 = as fast as possible, 1 = original timing, 2 = twice as fast")
+    ap.add_argument("--limit", type=int, default=0, help="stop after N updates")
+    ap.add_argument("--calls-out", help="write produced API calls (JSONL) here")
+    ap.add_argument("--baseline", help="compare produced API calls with this --calls-out file")
+    ap.add_argument("--menu", help="menu file that was live during recording (default: MENU_FILE)")
+    args = ap.parse_args()
+
+    # Не чіпаємо бойовий лічильник замовлень і склад: свіжий ledger у тимчасовій теці
+    tmp = Path(tempfile.mkdtemp())
+    bot.SEQ_FILE = tmp / "order_seq.json"
+    bot.STOCK = bot.StockLedger(tmp / "stock_state.json")
+    bot.STOCK.configure(bot.catalog())
+    if args.menu:
+        bot.MENU_FILE = Path(args.menu)
+    if bot.MENU_FILE.exists():
+        if not bot.reload_menu():
+            print(f"error: menu {bot.MENU_FILE} could not be loaded", file=sys.stderr)
+            return 2
+        print(f"menu: {bot.MENU_FILE}")
+    else:
+        print("menu: built-in DEFAULT_MENU")
+    request = StubRequest()
+    tg = ExtBot(os.environ["TELEGRAM_TOKEN"], request=request)
+    dp = Dispatcher(tg, Queue(), workers=1, use_context=True)
+    bot.register_handlers(dp, run_async=False)
+    errors = []
+    dp.add_error_handler(lambda update, ctx: errors.append(repr(ctx.error)))
+
+    produced, latencies = [], []
+    first_t = started = None
+    wall0 = time.monotonic()
+    for idx, rec in enumerate(read_records(args.logs)):
+        if args.limit and idx >= args.limit:
+            break
+        if args.speed > 0:
+            first_t = rec["t"] if first_t is None else first_t
+            started = time.monotonic() if started is None else started
+            delay = (rec["t"] - first_t) / args.speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(rec["update"], tg)
+        request.calls.clear()
+        t0 = time.perf_counter()
+        dp.process_update(update)
+        latencies.append(time.perf_counter() - t0)
+        produced += [dict(normalize(m, d), update=idx) for m, d in request.calls]
+    elapsed = time.monotonic() - wall0
+
+    lat = sorted(latencies)
+    n = len(lat)
+    print(f"updates: {n}, api calls: {len(produced)}, handler errors: {len(errors)}")
+    print(f"throughput: {n / elapsed if elapsed else 0:.1f} updates/s (wall {elapsed:.2f}s)")
+    print("latency ms: " + ", ".join(f"{name} {percentile(lat, q) * 1000:.2f}"
+                                     for name, q in (("p50", .5), ("p90", .9), ("p99", .99), ("max", 1))))
+    for err in errors[:5]:
+        print(f"  error: {err}")
+
+    if args.calls_out:
+        with open(args.calls_out, "w", encoding="utf-8") as f:
+            for call in produced:
+                f.write(json.dumps(call, ensure_ascii=False, sort_keys=True) + "\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            expected = [json.loads(line) for line in f if line.strip()]
+        diffs = [(i, a, b) for i, (a, b) in enumerate(itertools.zip_longest(expected, produced)) if a != b]
+        print(f"divergent api calls vs baseline: {len(diffs)} of {max(len(expected), len(produced))}")
+        for i, a, b in diffs[:5]:
+            print(f"  #{i}\n    baseline: {json.dumps(a, ensure_ascii=False)}\n    current:  {json.dumps(b, ensure_ascii=False)}")
+        return 1 if diffs else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
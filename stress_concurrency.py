@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Стрес-перевірка конкурентності: багато чатів одночасно проходять той самий
+# сценарій (адреса → телефон → toggles десертів → qty → подвійне «Підтвердити»)
+# через запущений Dispatcher з пулом воркерів і stub-ботом. Апдейти чатів
+# перемішані, як у реальному потоці. Наприкінці перевіряє, що жоден апдейт не
+# загубився й не виконався не в тому порядку, і що кожен чат має рівно одне
+# замовлення.
+#
+#   python stress_concurrency.py --chats 400 --workers 8 --rounds 3 --burst 4
+from __future__ import annotations
+
+import argparse, itertools, os, random, sys, tempfile, time
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+os.environ["TELEGRAM_TOKEN"] = "123456:replay"
+os.environ["ADMIN_CHAT_ID"] = "1"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import bot_ptb13 as bot  # noqa: E402
+from replay_updates import StubRequest  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Dispatcher, ExtBot  # noqa: E402
+
+FIRST_CHAT = 1000
+
+class SlowStubRequest(StubRequest):
+    # Bot API відповідає не миттєво: випадкова затримка розводить воркери в часі
+    __slots__ = ("api_ms",)
+
+    def __init__(self, api_ms: float):
+        super().__init__()
+        self.api_ms = api_ms
+
+    def post(self, url, data, timeout=None):
+        if self.api_ms:
+            time.sleep(random.uniform(0, 2 * self.api_ms) / 1000)
+        return super().post(url, data, timeout)
+
+class UpdateFactory:
+    def __init__(self, tg):
+        self.tg = tg
+        self._ids = itertools.count(1)
+
+    def _user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}"}
+
+    def _message(self, chat_id, text, entities=None):
+        msg = {"message_id": 1, "date": int(time.time()), "text": text,
+               "chat": {"id": chat_id, "type": "private"}, "from": self._user(chat_id)}
+        if entities:
+            msg["entities"] = entities
+        return msg
+
+    def text(self, chat_id, text):
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else None
+        uid = next(self._ids)
+        return Update.de_json({"update_id": uid, "message": self._message(chat_id, text, entities)}, self.tg)
+
+    def button(self, chat_id, data):
+        uid = next(self._ids)
+        query = {"id": str(uid), "from": self._user(chat_id), "chat_instance": str(chat_id),
+                 "data": data, "message": self._message(chat_id, "…")}
+        return Update.de_json({"update_id": uid, "callback_query": query}, self.tg)
+
+def scenario(make: UpdateFactory, chat_id: int, desserts):
+    a, b, c = desserts
+    return [
+        make.text(chat_id, "/start"),
+        make.button(chat_id, "ship:delivery"),
+        make.text(chat_id, f"addr {chat_id}"),
+        make.text(chat_id, f"+380{chat_id}"),
+        make.button(chat_id, "nav:desserts"),
+        make.button(chat_id, f"desserts:toggle:{a}"),
+        make.button(chat_id, f"desserts:toggle:{b}"),
+        make.button(chat_id, f"desserts:toggle:{c}"),
+        make.button(chat_id, "desserts:continue"),
+        make.button(chat_id, f"desserts:qty:{a}:1"),
+        make.button(chat_id, f"desserts:qty:{b}:2"),
+        make.button(chat_id, f"desserts:qty:{c}:3"),
+        make.button(chat_id, "order:confirm"),
+        make.button(chat_id, "order:confirm"),
+    ]
+
+def check(dp, chats, desserts) -> list:
+    a, b, c = desserts
+    expected_basket = {a: 1, b: 2, c: 3}
+    orders_by_chat = {}
+    for order_no, reg in dp.bot_data.get("orders", {}).items():
+        orders_by_chat.setdefault(reg["user_chat_id"], []).append(order_no)
+
+    problems = []
+    for chat_id in chats:
+        ses = dp.user_data.get(chat_id, {}).get("session")
+        if ses is None:
+            problems.append(f"chat {chat_id}: no session")
+            continue
+        got = {
+            "address": ses.address, "phone": ses.phone,
+            "queue": sorted(ses.qty_ds_queue), "basket": ses.basket_desserts,
+            "orders": len(orders_by_chat.get(chat_id, [])),
+        }
+        want = {
+            "address": f"addr {chat_id}", "phone": f"+380{chat_id}",
+            "queue": sorted(desserts), "basket": expected_basket, "orders": 1,
+        }
+        if got != want:
+            diff = {k: got[k] for k in want if got[k] != want[k]}
+            problems.append(f"chat {chat_id}: {diff}")
+    return problems
+
+def run_round(args, desserts) -> tuple:
+    request = SlowStubRequest(args.api_ms)
+    tg = ExtBot(os.environ["TELEGRAM_TOKEN"], request=request)
+    dp = Dispatcher(tg, Queue(), workers=args.workers, use_context=True)
+    bot.register_handlers(dp, run_async=True)
+    errors = []
+    dp.add_error_handler(lambda update, ctx: errors.append(repr(ctx.error)))
+
+    make = UpdateFactory(tg)
+    chats = range(FIRST_CHAT, FIRST_CHAT + args.chats)
+    scripts = [scenario(make, chat_id, desserts) for chat_id in chats]
+
+    thread = Thread(target=dp.start, name="dispatcher", daemon=True)
+    thread.start()
+    t0 = time.monotonic()
+    # Чати йдуть групами по --burst: сценарії групи випадково злиті зі збереженням
+    # порядку всередині чату, тож сусідні апдейти одного чату близько в черзі
+    for i in range(0, len(scripts), args.burst):
+        group = [list(s) for s in scripts[i:i + args.burst]]
+        while group:
+            script = random.choice(group)
+            dp.update_queue.put(script.pop(0))
+            if not script:
+                group.remove(script)
+    while dp.update_queue.qsize():
+        time.sleep(0.01)
+    dp.stop()  # дочікується всіх запланованих run_async
+    thread.join()
+    elapsed = time.monotonic() - t0
+    n = sum(len(s) for s in scripts)
+    return n, elapsed, errors, check(dp, chats, desserts)
+
+def main():
+    ap = argparse.ArgumentParser(description="Concurrent per-chat ordering stress test.")
+    ap.add_argument("--chats", type=int, default=400)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--burst", type=int, default=4, help="chats whose updates are interleaved together")
+    ap.add_argument("--api-ms", type=float, default=2.0, help="mean simulated Bot API latency")
+    args = ap.parse_args()
+
+    tmp = Path(tempfile.mkdtemp())
+    bot.SEQ_FILE = tmp / "order_seq.json"   # не чіпаємо бойовий лічильник
+    bot.STOCK._path = tmp / "stock_state.json"
+    desserts = list(bot.catalog().items["desserts"])[:3]
+
+    failed = False
+    for rnd in range(1, args.rounds + 1):
+        n, elapsed, errors, problems = run_round(args, desserts)
+        print(f"round {rnd}: {n} updates from {args.chats} chats on {args.workers} workers "
+              f"in {elapsed:.2f}s ({n / elapsed:.0f}/s), handler errors {len(errors)}, "
+              f"broken chats {len(problems)}")
+        for line in (errors + problems)[:5]:
+            print(f"  {line}")
+        failed = failed or bool(errors or problems)
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())